@@ -15,9 +15,10 @@ import numpy as np
 import librosa.display
 import scipy.signal
 import sounddevice as sd
+import soundfile as sf
 from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.QtWidgets import QFileDialog
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 
 import deep_dream
@@ -296,7 +297,7 @@ class Ui_DeepDreamSound(object):
                     print("Error: unable to start thread")
 
     def saveFile(self):
-        librosa.output.write_wav(self.savename, self.dreamt_signal, self.dreamt_sr)
+        sf.write(self.savename, self.dreamt_signal, self.dreamt_sr)
 
     def playOrgNewThread(self):
         try:
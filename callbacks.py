@@ -25,9 +25,10 @@ class Tensorboard(Callback):
         super().initialize()
 
     # pylint: disable=arguments-differ
-    def on_batch_end(self, net, y, y_pred, training, **kwargs):
+    def on_batch_end(self, net, batch, training, **kwargs):
+        _, y = batch
         self.y_trues_.append(y)
-        self.y_preds_.append(y_pred)
+        self.y_preds_.append(kwargs["y_pred"])
         if self._is_training and training:
             trues = torch.cat(tuple(self.y_trues_), dim=0)
             preds = torch.cat(tuple(self.y_preds_), dim=0)
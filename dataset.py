@@ -28,10 +28,12 @@ class ExtractStft(object):
         fouriered = librosa.stft(flac, n_fft=n_fft, hop_length=hop_length, win_length=window_size, center=True)
 
         mag, phase = librosa.magphase(fouriered)
-        mag = np.power(mag, constants.MAGNITUDE_NONLINEARITY)
+        np.power(mag, constants.MAGNITUDE_NONLINEARITY, out=mag)
         mag_max_value = mag.max()
 
-        mag = (1 - mag / mag.max()) * 255 - 127.5
+        # In-place form of (1 - mag / mag_max_value) * 255 - 127.5
+        mag *= -255.0 / mag_max_value
+        mag += 127.5
         return np.flipud(mag).copy()[..., np.newaxis], phase, mag_max_value
 
 
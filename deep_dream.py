@@ -1,12 +1,17 @@
 import os
-from functools import partial
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from typing import Iterable, Optional, Tuple
 
 import cv2
 import librosa
 import numpy as np
+import soundfile as sf
 import torch
 import torch.nn as nn
+import torch.nn.functional as functional
 import tqdm
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.pipeline import Pipeline
@@ -14,21 +19,33 @@ from skorch.net import NeuralNet
 
 import constants
 from dataset import ExtractStft
-from model import Classifier
-from pytorch_extensions import roll
+from model import Classifier, ResidualBlock2d
 
 
 class DataLoader(TransformerMixin, BaseEstimator):
     def fit(self, x, y, **fit_params):
         return self
 
-    @classmethod
-    def transform(cls, x: Iterable[str]) -> Iterable[Tuple[np.ndarray, int]]:
-        output = []
-        for file_name in x:
-            signal, sample_rate = librosa.load(file_name, sr=constants.LIBRISPEECH_SAMPLE_RATE)
-            output.append((signal, sample_rate))
-        return output
+    def transform(self, x: Iterable[str]) -> Iterable[Tuple[np.ndarray, int]]:
+        file_names = list(x)
+        if not file_names:
+            return
+        max_workers = min(len(file_names), os.cpu_count())
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Keep at most max_workers files in flight so the next files load
+            # while the current one is dreamt, without holding the whole
+            # dataset in memory at once.
+            pending = deque()
+            for file_name in file_names:
+                pending.append(pool.submit(self._load_file, file_name))
+                if len(pending) > max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @staticmethod
+    def _load_file(file_name: str) -> Tuple[np.ndarray, int]:
+        return librosa.load(file_name, sr=constants.LIBRISPEECH_SAMPLE_RATE, dtype=np.float32)
 
 
 class DataPreprocessor(TransformerMixin, BaseEstimator):
@@ -42,14 +59,37 @@ class DataPreprocessor(TransformerMixin, BaseEstimator):
         return self
 
     def transform(self, x: Iterable[Tuple[np.ndarray, int]]) -> Iterable[Tuple[np.ndarray, int, float, np.ndarray]]:
-        output = []
         for signal, sample_rate in x:
             stacked, phase, mag_max_value = ExtractStft.get_stft(signal,
                                                                  n_fft=self._params.components,
                                                                  hop_length=self._params.hop_length,
                                                                  window_size=self._params.window_size)
-            output.append((stacked, sample_rate, mag_max_value, phase))
-        return output
+            yield stacked, sample_rate, mag_max_value, phase
+
+
+@lru_cache(maxsize=4)
+def _load_classifier(model_path: str, use_gpu: bool) -> Classifier:
+    classifier = Classifier(constants.NUMBER_OF_CLASSES)
+    net = NeuralNet(
+        classifier, nn.CrossEntropyLoss
+    )
+    net.initialize()
+    net.load_params(f_params=model_path)
+    classifier = classifier.eval()
+    # Shared across Model instances, so the weights must never be touched by
+    # a backward pass; input gradients are unaffected.
+    for param in classifier.parameters():
+        param.requires_grad = False
+
+    for layer in classifier.layers_blocks.values():
+        if isinstance(layer, ResidualBlock2d):
+            layer.fuse_batchnorms()
+
+    if use_gpu:
+        classifier = classifier.cuda()
+        # Tile shapes repeat across iterations, so autotuned conv algorithms pay off.
+        torch.backends.cudnn.benchmark = True
+    return classifier
 
 
 class Model(TransformerMixin, BaseEstimator):
@@ -64,7 +104,9 @@ class Model(TransformerMixin, BaseEstimator):
                  use_gpu: bool = False,
                  verbose: bool = False,
                  seed: Optional[int] = None,
-                 stream: Optional = None):
+                 stream: Optional = None,
+                 compile_model: bool = True,
+                 tile_batch_size: int = 64):
         if use_slower_better_model:
             self._params = constants.AUDIO_PARAMS_SLOWER_BETTER_MODEL
         else:
@@ -79,43 +121,44 @@ class Model(TransformerMixin, BaseEstimator):
         self._optimisation_step_size = optimisation_step_size
         self._filter_index = filter_index
         self._stream = stream
+        self._tile_batch_size = tile_batch_size
         self._np_rng = np.random.RandomState(seed)
 
-        self._available_layers = {}
-        self._available_layers_names = []
+        self._grads_buffer: Optional[torch.Tensor] = None
+        self._grads_buffer_tile_size: Optional[int] = None
 
-        self._classifier = Classifier(constants.NUMBER_OF_CLASSES)
+        self._classifier = _load_classifier(self._model_path, self._use_gpu)
 
-        self._net = NeuralNet(
-            self._classifier, nn.CrossEntropyLoss
-        )
+        self._available_layers_names = [layer_name for layer_name in self._classifier.layers_blocks
+                                        if "residual" in layer_name]
 
-        self._net.initialize()
-        self._net.load_params(f_params=self._model_path)
-        self._classifier = self._classifier.eval()
+        if self._block_name not in self._classifier.layers_blocks:
+            raise ValueError(f"Unknown block name: {self._block_name}")
 
+        # Only the layers up to the dream objective are ever needed, so the
+        # deeper blocks and the classification head are skipped entirely.
+        feature_layers = []
         for layer_name, layer in self._classifier.layers_blocks.items():
-            if "residual" in layer_name:
-                current_register = partial(self._register_layer_output, layer_name=layer_name)
-                layer.register_forward_hook(current_register)
-                self._available_layers_names.append(layer_name)
+            feature_layers.append(layer)
+            if layer_name == self._block_name:
+                break
+        self._feature_extractor = nn.Sequential(*feature_layers)
+
+        if compile_model and hasattr(torch, "compile"):
+            self._feature_extractor = torch.compile(self._feature_extractor, mode="reduce-overhead",
+                                                    fullgraph=False)
 
         if self._verbose:
             print(f"Available layer names: \n{self._available_layers_names}")
 
-    def _register_layer_output(self, module, input_, output, layer_name):
-        self._available_layers[layer_name] = output
-
     def fit(self, x, y, **fit_params):
         return self
 
     def transform(self, x: Iterable[Tuple[np.ndarray, int, float, np.ndarray]]) \
             -> Iterable[Tuple[np.ndarray, int, float, np.ndarray]]:
-        output = []
         for stft, sample_rate, mag_max_value, phase in x:
             prediction = self._transform_single_normal_deep_dream(stft)
-            output.append((prediction, sample_rate, mag_max_value, phase))
-        return output
+            yield prediction, sample_rate, mag_max_value, phase
 
     def _transform_single_normal_deep_dream(self, stft: np.ndarray) -> np.ndarray:
         octaves = []
@@ -126,48 +169,86 @@ class Model(TransformerMixin, BaseEstimator):
             stft = lo
             octaves.append(hi)
 
+        stft = self._to_device(stft)
+
         for octave in tqdm.trange(self._n_octaves, desc="Image optimisation", file=self._stream):
             if octave > 0:
-                hi = octaves[-octave]
-                stft = cv2.resize(stft, tuple(np.int32(hi.shape[:2][::-1])))[..., None] + hi
-
-            stft = torch.from_numpy(stft).float()
-            if self._use_gpu:
-                stft = stft.cuda()
-            stft = stft.permute((2, 0, 1))
+                hi = self._to_device(octaves[-octave])
+                stft = functional.interpolate(stft[None], size=hi.shape[1:], mode="bilinear",
+                                              align_corners=False)[0] + hi
 
             for i in tqdm.trange(self._number_of_iterations, desc="Octave optimisation", file=self._stream):
                 g = self.calc_grad_tiled(stft)
-                g /= (g.abs().mean() + 1e-8)
-                g *= self._optimisation_step_size
-                stft += g
+                with torch.no_grad():
+                    g /= (g.abs().mean() + 1e-8)
+                    g *= self._optimisation_step_size
+                    stft += g
+
+        if self._use_gpu:
+            stft = stft.cpu()
 
-            if self._use_gpu:
-                stft = stft.cpu()
+        return stft.numpy().transpose((1, 2, 0))
 
-            stft = stft.detach().numpy().transpose((1, 2, 0))
+    def _to_device(self, stft: np.ndarray) -> torch.Tensor:
+        tensor = torch.from_numpy(stft).permute((2, 0, 1))
+        if self._use_gpu:
+            tensor = tensor.pin_memory().cuda(non_blocking=True)
+        return tensor
 
-        return stft
+    def _autocast(self):
+        if self._use_gpu:
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        return nullcontext()
 
     def calc_grad_tiled(self, stft: torch.Tensor, tile_size: int = 128) -> torch.Tensor:
         h, w = stft.shape[1:]
         sx, sy = self._np_rng.randint(tile_size, size=2)
-        stft_shift = roll(roll(stft, sx, axis=2), sy, axis=1)
-        grads = torch.zeros_like(stft)
+        stft_shift = torch.roll(stft, shifts=(sy, sx), dims=(1, 2))
+
+        # Reused across the iterations of an octave; with an unchanged tile
+        # grid the tiles overwrite the same regions every call, so the buffer
+        # never needs re-zeroing.
+        grads = self._grads_buffer
+        if (grads is None or grads.shape != stft.shape or grads.device != stft.device
+                or self._grads_buffer_tile_size != tile_size):
+            grads = torch.zeros_like(stft)
+            self._grads_buffer = grads
+            self._grads_buffer_tile_size = tile_size
+
+        # Edge tiles can be smaller than tile_size, so tiles are grouped by shape
+        # and each group runs through the classifier as one batch.
+        tiles_by_shape = defaultdict(list)
+        x_range = range(0, max(w - tile_size // 2, tile_size), tile_size)
         for y in range(0, max(h - tile_size // 2, tile_size), tile_size):
-            for x in range(0, max(w - tile_size // 2, tile_size), tile_size):
+            for x in x_range:
                 frame = stft_shift[:, y:y + tile_size, x:x + tile_size]
-                frame.requires_grad = True
-                self._classifier(frame[None])
-
-                layer_output = self._available_layers[self._block_name][0, self._filter_index]
-                objective_output = layer_output.mean()
+                tiles_by_shape[frame.shape[1:]].append((y, x, frame))
+
+        tile_batch_size = self._tile_batch_size
+        feature_extractor = self._feature_extractor
+        filter_index = self._filter_index
+        for tiles in tiles_by_shape.values():
+            # Padding the tail sub-batch keeps the batch shape static, so the
+            # compiled/autotuned full-batch path is reused instead of
+            # specializing again for the leftover size.
+            pad_tail = len(tiles) > tile_batch_size
+            for start in range(0, len(tiles), tile_batch_size):
+                chunk = tiles[start:start + tile_batch_size]
+                batch = torch.stack([frame for _, _, frame in chunk])
+                if pad_tail and len(chunk) < tile_batch_size:
+                    padding = batch.new_zeros((tile_batch_size - len(chunk),) + batch.shape[1:])
+                    batch = torch.cat((batch, padding))
+                batch.requires_grad = True
+
+                with self._autocast():
+                    layer_output = feature_extractor(batch)[:, filter_index]
+                    objective_output = layer_output.mean(dim=(-2, -1)).sum()
                 objective_output.backward()
 
-                frame.requires_grad = False
-                grad = frame.grad.detach().clone()
-                grads[:, y:y + tile_size, x:x + tile_size] = grad
-        result = roll(roll(grads, -sx, axis=2), -sy, axis=1)
+                batch_grad = batch.grad.detach()
+                for i, (y, x, _) in enumerate(chunk):
+                    grads[:, y:y + tile_size, x:x + tile_size] = batch_grad[i]
+        result = torch.roll(grads, shifts=(-sy, -sx), dims=(1, 2))
         return result
 
 
@@ -182,22 +263,26 @@ class Denormalize(TransformerMixin, BaseEstimator):
         return self
 
     def transform(self, x: Iterable[Tuple[np.ndarray, int, float, np.ndarray]]) -> Iterable[Tuple[np.ndarray, int]]:
-        output = []
         for stft, fs, mag_max_value, phase in x:
-            stft = np.flipud(stft)[..., 0]
-            stft = (stft + 127.5)
-            out = (1 - stft / stft.max()) * mag_max_value
-            out = np.power(out, 1 / constants.MAGNITUDE_NONLINEARITY)
+            out = np.flipud(stft)[..., 0] + 127.5
+            # In-place form of (1 - out / out.max()) * mag_max_value
+            out *= -1.0 / out.max()
+            out += 1.0
+            out *= mag_max_value
+            np.power(out, 1 / constants.MAGNITUDE_NONLINEARITY, out=out)
 
             stft = out * phase
             unfouriered = librosa.istft(stft,
                                         win_length=self._params.window_size,
                                         hop_length=self._params.hop_length,
                                         center=True)
-            unfouriered = ((unfouriered - unfouriered.min()) / (unfouriered.max() - unfouriered.min()) - 0.5) * 8
-            unfouriered = np.clip(unfouriered, -1, 1)
-            output.append((unfouriered, fs))
-        return output
+            # In-place form of ((u - u.min()) / (u.max() - u.min()) - 0.5) * 8
+            signal_min, signal_max = unfouriered.min(), unfouriered.max()
+            unfouriered -= signal_min
+            unfouriered *= 8.0 / (signal_max - signal_min)
+            unfouriered -= 4.0
+            np.clip(unfouriered, -1, 1, out=unfouriered)
+            yield unfouriered, fs
 
 
 class SaveResult(TransformerMixin, BaseEstimator):
@@ -209,12 +294,10 @@ class SaveResult(TransformerMixin, BaseEstimator):
         return self
 
     def transform(self, x: Iterable[Tuple[np.ndarray, int]]) -> Iterable[Tuple[np.ndarray, int]]:
-        output = []
         for i, (signal, fs) in enumerate(x):
             path = os.path.join(self.output_dir, self.base_name + "_{}.mp3".format(i))
-            librosa.output.write_wav(path, signal, fs, norm=True)
-            output.append((signal, fs))
-        return output
+            sf.write(path, signal / np.max(np.abs(signal)), fs)
+            yield signal, fs
 
 
 def get_processing_pipeline(use_better_slower_model=True, dreamstream=None) -> Pipeline:
@@ -238,7 +321,7 @@ def get_processing_pipeline(use_better_slower_model=True, dreamstream=None) -> P
 
 def backend(filepath, dreamstream):
     pipe = get_processing_pipeline(use_better_slower_model=False, dreamstream=dreamstream)
-    return pipe.transform([filepath])
+    return list(pipe.transform([filepath]))
 
 
 
@@ -249,7 +332,7 @@ def main():
     args = parser.parse_args()
 
     pipe = get_processing_pipeline()
-    return pipe.transform([args.file_path])
+    return list(pipe.transform([args.file_path]))
 
 
 if __name__ == '__main__':
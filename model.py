@@ -4,6 +4,8 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as functional
 
+from pytorch_extensions import fuse_conv_bn
+
 
 class ResidualBlock2d(nn.Module):
     def __init__(self, in_filters: int, out_filters: int, kernel_size: int, stride: int):
@@ -42,6 +44,16 @@ class ResidualBlock2d(nn.Module):
             x = self.linear_transform(inputs) + x
         return self.out_relu(x)
 
+    def fuse_batchnorms(self):
+        """Folds the eval-mode batch norms into their convolutions. Inference only."""
+        self.conv_1 = nn.Sequential(OrderedDict((
+            ("conv_1", fuse_conv_bn(self.conv_1.conv_1, self.conv_1.batchnorm_1)),
+            ("relu_1", self.conv_1.relu_1),
+        )))
+        self.conv_2 = nn.Sequential(OrderedDict((
+            ("conv_2", fuse_conv_bn(self.conv_2.conv_2, self.conv_2.batchnorm_2)),
+        )))
+
 
 class Classifier(nn.Module):
     def __init__(self, n_classes: int):
@@ -1,4 +1,19 @@
 import torch
+import torch.nn as nn
+
+
+def fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    """
+    Folds an eval-mode batch norm into the preceding convolution.
+    :param conv: nn.Conv2d with a bias, modified in place.
+    :param bn: nn.BatchNorm2d whose running statistics are frozen.
+    :return: The convolution, now computing conv followed by the batch norm affine.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    with torch.no_grad():
+        conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+        conv.bias.copy_((conv.bias - bn.running_mean) * scale + bn.bias)
+    return conv
 
 
 def roll(tensor: torch.Tensor, shift: int, axis: int = 0) -> torch.Tensor:
@@ -18,10 +33,10 @@ def pad1d(tensor: torch.Tensor, pad_size: tuple) -> torch.Tensor:
     :return: Padded tensor with constant values equal to mean.
     """
     left, right = pad_size
-    output = torch.zeros_like(tensor)
-    output.fill_(tensor.mean())
+    output = torch.empty(tensor.shape[0] + left + right,
+                         dtype=tensor.dtype, device=tensor.device).fill_(tensor.mean())
     if right > 0:
         output[left:-right] = tensor
     else:
         output[left:] = tensor
-    return tensor
+    return output